@@ -0,0 +1,18 @@
+# Gunicorn reads this file automatically from the working directory.
+
+# Build the app once in the master and fork it into the workers. This is safe
+# because create_app() neither connects to the database nor creates tables.
+preload_app = True
+
+# /events keeps connections open for as long as the client listens. gevent
+# workers serve each connection from a greenlet instead of tying up a worker.
+worker_class = 'gevent'
+worker_connections = 5000
+
+
+def post_fork(server, worker):
+    # Never share pooled connections across processes: give each worker a fresh pool.
+    from pj import db
+
+    with server.app.wsgi().app_context():
+        db.engine.dispose()
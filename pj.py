@@ -1,32 +1,50 @@
 import os
-from datetime import datetime, timedelta
-from math import pow
+import codecs
+import csv
+import gzip
+import io
+import hashlib
+import multiprocessing
+import threading
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta, timezone
+from functools import wraps
+from math import ceil, pow
 
 import json
-from flask import Flask, request, jsonify, render_template, abort
+import click
+import numpy as np
+from flask import (Blueprint, Flask, current_app, make_response, request, jsonify, render_template, abort,
+                   stream_with_context)
+from flask.cli import with_appcontext
 from flask_cors import CORS
 from flask_marshmallow import Marshmallow
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import *
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import selectinload
 from sqlalchemy.ext.declarative import declarative_base
+from werkzeug.exceptions import HTTPException
+from werkzeug.middleware.proxy_fix import ProxyFix
 
-Base = declarative_base()
+try:
+    import brotli
+except ImportError:  # optional, gzip is always available
+    brotli = None
 
+Base = declarative_base()
 
-app = Flask(__name__)
-CORS(app)
 
-basedir = os.path.abspath(os.path.dirname(__file__))
-# CREATE DATABASE, "test.db" is database's name
-uri = os.getenv("DATABASE_URL")  # or other relevant config var
-if uri and uri.startswith("postgres://"):
-    uri = uri.replace("postgres://", "postgresql://", 1)
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(uri, "sqlite:///test.db")
-# Optional: But it will silence the deprecation warning in the console.
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(app)
+# Extensions are bound to an app in create_app(), so importing this module
+# doesn't build an app, open an engine or touch the database.
+db = SQLAlchemy()
+ma = Marshmallow()
 
-ma = Marshmallow(app)
+bp = Blueprint('pj', __name__)
 
 class Member(db.Model):
     __tablename__ = "member"
@@ -48,7 +66,8 @@ class Order(db.Model):
     __tablename__ = "order"
     order_id = db.Column(db.Integer, primary_key=True)
     total_amount = db.Column(db.Integer, nullable=False)
-    date = db.Column(db.DateTime, nullable=False)
+    # Indexed: season sales, predictions and customer metrics all read a date range.
+    date = db.Column(db.DateTime, nullable=False, index=True)
     quantity = db.Column(db.Integer, nullable=False)
 
     # 一對多的多
@@ -121,6 +140,71 @@ class Season_Sale(db.Model):
         self.season = season
         self.sale = sale
 
+# A closed year whose orders were moved to archived_order by `flask archive-orders`.
+class Order_Archive(db.Model):
+    __tablename__ = "order_archive"
+    year = db.Column(db.Integer, primary_key=True)
+    orders = db.Column(db.Integer, nullable=False)
+    total_amount = db.Column(db.Integer, nullable=False)
+
+    def __init__(self, year, orders, total_amount):
+        self.year = year
+        self.orders = orders
+        self.total_amount = total_amount
+
+# Orders of the archived years, with the columns of "order" but without its foreign
+# keys: history doesn't stop a member or product from being deleted.
+class Archived_Order(db.Model):
+    __tablename__ = "archived_order"
+    order_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    total_amount = db.Column(db.Integer, nullable=False)
+    date = db.Column(db.DateTime, nullable=False, index=True)
+    quantity = db.Column(db.Integer, nullable=False)
+    member_id = db.Column(db.Integer, nullable=False)
+    product_id = db.Column(db.Integer, nullable=False)
+
+    def __init__(self, order_id, total_amount, member_id, date, quantity, product_id):
+        self.order_id = order_id
+        self.total_amount = total_amount
+        self.member_id = member_id
+        self.date = date
+        self.quantity = quantity
+        self.product_id = product_id
+
+# Bumped by every write to a resource ("product", "material", "season_sale"),
+# in the same transaction. Drives the ETag/Last-Modified of the GET endpoints.
+class Resource_Version(db.Model):
+    __tablename__ = "resource_version"
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+    updated = db.Column(db.DateTime, nullable=False)
+
+    def __init__(self, name, updated):
+        self.name = name
+        self.version = 1
+        self.updated = updated
+
+# Append-only log of stock changes, streamed to clients by every worker's /events.
+class Stock_Event(db.Model):
+    __tablename__ = "stock_event"
+    id = db.Column(db.Integer, primary_key=True)
+    event = db.Column(db.String(20), nullable=False)  # "stock" or "reorder"
+    item_type = db.Column(db.String(20), nullable=False)  # "product" or "material"
+    item_id = db.Column(db.Integer, nullable=False)
+    name = db.Column(db.String(50), nullable=False)
+    on_hand_balance = db.Column(db.Integer, nullable=False)
+    reorder_point = db.Column(db.Float, nullable=False)
+    date = db.Column(db.DateTime, nullable=False)
+
+    def __init__(self, event, item_type, item_id, name, on_hand_balance, reorder_point, date):
+        self.event = event
+        self.item_type = item_type
+        self.item_id = item_id
+        self.name = name
+        self.on_hand_balance = on_hand_balance
+        self.reorder_point = reorder_point
+        self.date = date
+
 # Member Schema
 class MemberSchema(ma.Schema):
     class Meta:
@@ -139,7 +223,7 @@ class ProductSchema(ma.Schema, json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
     class Meta:
         fields = ('product_id', 'product_name', 'price', 'on_hand_balance',
-                  'leading_time', 'reorder_point', 'product_material_relation')
+                  'leading_time', 'reorder_point')
 
 # Material schema
 class MaterialSchema(ma.Schema, json.JSONEncoder):
@@ -174,18 +258,461 @@ materials_material_schema = MaterialMaterialSchema(many=True)
 season_sale_schema = SeasonSaleSchema()
 season_sales_schema = SeasonSaleSchema(many=True)
 
-db.create_all()
 
-@app.route('/')
+# Create the tables once at deploy time instead of on every import:
+#   FLASK_APP=pj flask init-db
+@click.command('init-db')
+@with_appcontext
+def init_db_command():
+    db.create_all()
+    # create_all() skips tables that already exist, add indexes introduced since.
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    # Seed the version rows here, so concurrent first writers never race to insert one.
+    now = datetime.utcnow()
+    for name in cached_resources:
+        if Resource_Version.query.get(name) is None:
+            db.session.add(Resource_Version(name, now))
+    db.session.commit()
+    click.echo('Initialized the database.')
+
+
+def create_app(config=None):
+    started = time.perf_counter()
+
+    app = Flask(__name__)
+    CORS(app)
+
+    # DATABASE, "test.db" is the default database's name
+    uri = os.getenv("DATABASE_URL")  # or other relevant config var
+    if uri and uri.startswith("postgres://"):
+        uri = uri.replace("postgres://", "postgresql://", 1)
+    app.config['SQLALCHEMY_DATABASE_URI'] = uri or "sqlite:///test.db"
+    # Optional: But it will silence the deprecation warning in the console.
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # Responses smaller than this (in bytes) are sent uncompressed.
+    app.config['COMPRESS_MIN_SIZE'] = 1024
+    # /events: seconds between checks for new stock events, seconds between
+    # keep-alive comments, and how many past events a reconnecting client can replay.
+    app.config['EVENTS_POLL_INTERVAL'] = 1.0
+    app.config['EVENTS_KEEPALIVE'] = 15
+    app.config['EVENTS_BUFFER_SIZE'] = 1000
+    # How long a missing event id holds back the ones after it (its transaction may
+    # not have committed yet), and seconds between trims of old stock_event rows.
+    app.config['EVENTS_GAP_TIMEOUT'] = 5
+    app.config['EVENTS_PRUNE_INTERVAL'] = 60
+    # Rows validated and written per bulk statement by /import and `flask import-data`.
+    app.config['IMPORT_CHUNK_SIZE'] = 10000
+    # Processes /analytics/batch spreads its as_of dates over; 1 computes in the request.
+    app.config['ANALYTICS_PROCESSES'] = 1
+    # Write admission, per worker: sustained writes per second and burst allowed per
+    # client, writes in progress before new ones get a 503, and how long (ms) the first
+    # order of a batch waits for others to share its commit (0 commits each on its own).
+    app.config['WRITE_RATE'] = 5.0
+    app.config['WRITE_BURST'] = 20
+    app.config['WRITE_QUEUE_SIZE'] = 32
+    app.config['WRITE_GROUP_COMMIT_MS'] = 5
+    # Proxies in front of the app that append to X-Forwarded-For (1: the Heroku router),
+    # so request.remote_addr, which write admission keys on, is the client. 0 if none.
+    app.config['PROXY_FIX_X_FOR'] = 1
+    # Override any of the above, e.g. create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://'}) in tests.
+    if config:
+        app.config.update(config)
+    if app.config['PROXY_FIX_X_FOR']:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_X_FOR'])
+
+    # The engine is only created on first use, i.e. inside the worker after fork.
+    db.init_app(app)
+    ma.init_app(app)
+    app.register_blueprint(bp)
+    app.cli.add_command(init_db_command)
+    app.cli.add_command(prune_events_command)
+    app.cli.add_command(import_data_command)
+    app.cli.add_command(export_data_command)
+    app.cli.add_command(archive_orders_command)
+
+    app.config['STARTUP_SECONDS'] = time.perf_counter() - started
+    app.logger.info("app created in %.1f ms", app.config['STARTUP_SECONDS'] * 1000)
+    return app
+
+
+
+@bp.route('/')
 def home():
     # READ ALL RECORDS
     all_members = db.session.query(Member).all()
     print(all_members)
     return render_template("index.html", members=all_members)
 
+##### HTTP CACHING #####
+# Content codings we can produce, best first.
+compressors = {}
+if brotli is not None:
+    compressors['br'] = brotli.compress
+compressors['gzip'] = gzip.compress
+
+# The resources with a Resource_Version row, seeded by init-db.
+cached_resources = ('product', 'material', 'season_sale')
+
+# Mark resources as changed. Call before db.session.commit() so the bump is part of the write.
+def bump_version(*names):
+    now = datetime.utcnow()
+    for name in names:
+        updated = Resource_Version.query.filter_by(name=name).update(
+            {'version': Resource_Version.version + 1, 'updated': now}, synchronize_session=False)
+        if not updated:
+            # Only on a database init-db hasn't seeded.
+            db.session.add(Resource_Version(name, now))
+
+# Serve a GET endpoint with an ETag built from the versions of the resources it reads.
+# A matching If-None-Match / If-Modified-Since gets a 304 after a single primary key
+# lookup, without running the view's queries or serializing anything.
+def conditional(*resources):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            rows = Resource_Version.query.filter(Resource_Version.name.in_(resources)).all()
+            versions = sorted((row.name, row.version) for row in rows)
+            etag = hashlib.sha1(json.dumps([request.full_path, versions]).encode()).hexdigest()
+            last_modified = max((row.updated for row in rows), default=None)
+
+            if request.if_none_match:
+                # Compressed representations carry the coding as a suffix, see compress_response().
+                # Weak comparison (RFC 7232 3.2): proxies that compress send the tag back as W/"...".
+                candidates = [etag] + [f'{etag}-{encoding}' for encoding in compressors]
+                matched = next((tag for tag in candidates if request.if_none_match.contains_weak(tag)), None)
+            elif (last_modified and request.if_modified_since and
+                    last_modified.replace(microsecond=0, tzinfo=timezone.utc) <= request.if_modified_since):
+                matched = etag
+            else:
+                matched = None
+
+            if matched:
+                response = current_app.response_class(status=304)
+                response.set_etag(matched)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                response.set_etag(etag)
+            if last_modified:
+                response.last_modified = last_modified
+            # Let the browser keep the body, but revalidate on every poll.
+            response.cache_control.no_cache = True
+            response.vary.add('Accept-Encoding')
+            return response
+        return wrapper
+    return decorator
+
+# gzip (or br, when brotli is installed) large responses for clients that accept it.
+@bp.after_app_request
+def compress_response(response):
+    if (response.status_code != 200 or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or (response.content_length or 0) < current_app.config['COMPRESS_MIN_SIZE']):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = next((encoding for encoding in compressors if request.accept_encodings[encoding]), None)
+    if encoding is None:
+        return response
+    response.set_data(compressors[encoding](response.get_data()))
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f'{etag}-{encoding}', weak)
+    return response
+
+##### STOCK EVENTS #####
+# Log a product's or material's new balance, plus a "reorder" event when it is at or
+# below its reorder point. Call before db.session.commit() so it is part of the write.
+def record_stock_event(item_type, item):
+    item_id = getattr(item, f'{item_type}_id')
+    name = getattr(item, f'{item_type}_name')
+    now = datetime.utcnow()
+    events = ['stock']
+    if item.on_hand_balance <= item.reorder_point:
+        events.append('reorder')
+    for event in events:
+        db.session.add(Stock_Event(event, item_type, item_id, name, item.on_hand_balance, item.reorder_point, now))
+
+# Delete all but the newest `keep` stock events, older ones are past the replay window.
+def prune_stock_events(keep):
+    newest = db.session.query(func.max(Stock_Event.id)).scalar()
+    if newest is not None and newest > keep:
+        Stock_Event.query.filter(Stock_Event.id <= newest - keep).delete(synchronize_session=False)
+    db.session.commit()
+
+#   flask prune-events
+@click.command('prune-events')
+@with_appcontext
+def prune_events_command():
+    prune_stock_events(current_app.config['EVENTS_BUFFER_SIZE'])
+    click.echo('Pruned stock events.')
+
+# Fans stock events out to the /events subscribers of one worker. A single poller reads
+# new rows from stock_event (written by any worker) into a ring buffer and wakes every
+# waiting subscriber, so idle connections cost no queries and, under the gevent worker,
+# no threads. The poller also trims the table down to the replay window.
+class EventBroker:
+    def __init__(self, app):
+        self.app = app
+        self.events = deque(maxlen=app.config['EVENTS_BUFFER_SIZE'])
+        self.condition = threading.Condition()
+        self.last_id = 0
+        self.gap_since = None
+        self.pruned = time.monotonic()
+
+        # Start from recent history, so clients can replay what they missed.
+        recent = Stock_Event.query.order_by(desc(Stock_Event.id)).limit(self.events.maxlen).all()
+        self.publish(reversed(recent))
+        db.session.remove()
+
+    def start(self):
+        threading.Thread(target=self.poll, daemon=True).start()
+
+    def publish(self, rows):
+        # Format each event once here rather than once per subscriber.
+        messages = []
+        for row in rows:
+            data = json.dumps({'type': row.item_type, 'id': row.item_id, 'name': row.name,
+                               'on_hand_balance': row.on_hand_balance, 'reorder_point': row.reorder_point,
+                               'date': row.date.isoformat()})
+            messages.append((row.id, f'id: {row.id}\nevent: {row.event}\ndata: {data}\n\n'))
+        if messages:
+            with self.condition:
+                self.events.extend(messages)
+                self.last_id = messages[-1][0]
+                self.condition.notify_all()
+
+    def poll(self):
+        with self.app.app_context():
+            while True:
+                time.sleep(self.app.config['EVENTS_POLL_INTERVAL'])
+                try:
+                    self.poll_once()
+                    if time.monotonic() - self.pruned >= self.app.config['EVENTS_PRUNE_INTERVAL']:
+                        self.pruned = time.monotonic()
+                        prune_stock_events(self.events.maxlen)
+                except Exception:
+                    self.app.logger.exception("polling stock events failed")
+                finally:
+                    # Don't hold a connection or an open transaction between polls.
+                    db.session.remove()
+
+    # Publish new events in id order. Ids are handed out when a row is inserted, not when
+    # it commits, so with concurrent writers (Postgres) id N can become visible after N+1.
+    # A missing id therefore holds back the events after it until it shows up, or until
+    # EVENTS_GAP_TIMEOUT has passed and it is taken as rolled back.
+    def poll_once(self):
+        rows = Stock_Event.query.filter(Stock_Event.id > self.last_id).order_by(Stock_Event.id).all()
+        now = time.monotonic()
+        ready = []
+        expected = self.last_id + 1
+        for row in rows:
+            if row.id > expected:
+                if self.gap_since is None:
+                    self.gap_since = now
+                if now - self.gap_since < self.app.config['EVENTS_GAP_TIMEOUT']:
+                    break
+            self.gap_since = None
+            ready.append(row)
+            expected = row.id + 1
+        self.publish(ready)
+
+    # Messages after last_id, waiting up to timeout seconds for one to arrive.
+    def wait(self, last_id, timeout):
+        with self.condition:
+            if self.last_id <= last_id:
+                self.condition.wait(timeout)
+            messages = []
+            for event_id, message in reversed(self.events):
+                if event_id <= last_id:
+                    break
+                messages.append((event_id, message))
+        messages.reverse()
+        return messages
+
+# One broker per worker, created on first use: after fork, and after gevent has patched threading.
+def get_event_broker():
+    app = current_app._get_current_object()
+    if 'event_broker' not in app.extensions:
+        app.extensions['event_broker'] = EventBroker(app)
+        app.extensions['event_broker'].start()
+    return app.extensions['event_broker']
+
+# Server-sent events: "stock" whenever a balance changes, "reorder" when an item is at or
+# below its reorder point. Reconnecting clients send Last-Event-ID to replay missed events.
+@bp.route('/events', methods=['GET'])
+def stream_events():
+    broker = get_event_broker()
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    if last_id is None:
+        last_id = broker.last_id
+    keepalive = current_app.config['EVENTS_KEEPALIVE']
+
+    def stream(last_id):
+        yield 'retry: 3000\n\n'
+        while True:
+            messages = broker.wait(last_id, keepalive)
+            if not messages:
+                yield ': keep-alive\n\n'
+            for last_id, message in messages:
+                yield message
+
+    return current_app.response_class(stream(last_id), mimetype='text/event-stream',
+                                      headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+##### WRITE ADMISSION #####
+# Guards the write endpoints of one worker. Each client (by address, see PROXY_FIX_X_FOR)
+# gets a token bucket, and only
+# WRITE_QUEUE_SIZE writes may be in progress at once, so a burst gets a quick 429 or 503
+# with Retry-After instead of piling up behind the database's write lock. Orders arriving
+# within WRITE_GROUP_COMMIT_MS of each other are written in one transaction.
+class WriteAdmission:
+    def __init__(self, app):
+        self.app = app
+        self.lock = threading.Lock()
+        self.buckets = {}  # client -> (tokens, last refill)
+        self.pending = 0
+        self.batch = None  # orders waiting for the current group commit
+        self.stats = {'admitted': 0, 'rate_limited': 0, 'queue_full': 0,
+                      'batches': 0, 'batched_orders': 0, 'largest_batch': 0}
+
+    # None if the write may go ahead, else (status, seconds to wait before retrying).
+    def admit(self, client):
+        rate = self.app.config['WRITE_RATE']
+        burst = self.app.config['WRITE_BURST']
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.get(client, (burst, now))
+            tokens = min(burst, tokens + (now - last) * rate)
+            if tokens < 1:
+                self.buckets[client] = (tokens, now)
+                self.stats['rate_limited'] += 1
+                return 429, ceil((1 - tokens) / rate)
+            if self.pending >= self.app.config['WRITE_QUEUE_SIZE']:
+                self.buckets[client] = (tokens, now)
+                self.stats['queue_full'] += 1
+                return 503, 1
+            if len(self.buckets) > 10000:
+                # Forget idle clients, their buckets would be full again anyway.
+                self.buckets = {key: value for key, value in self.buckets.items()
+                                if value[0] + (now - value[1]) * rate < burst}
+            self.buckets[client] = (tokens - 1, now)
+            self.pending += 1
+            self.stats['admitted'] += 1
+        return None
+
+    def release(self):
+        with self.lock:
+            self.pending -= 1
+
+    # Add an order through the group commit and return it serialized. The first order
+    # of a batch waits WRITE_GROUP_COMMIT_MS, then writes every order that joined.
+    def submit_order(self, request_data):
+        slot = {'data': request_data, 'done': threading.Event(), 'result': None, 'error': None}
+        with self.lock:
+            leader = self.batch is None
+            if leader:
+                self.batch = []
+            batch = self.batch
+            batch.append(slot)
+        if leader:
+            time.sleep(self.app.config['WRITE_GROUP_COMMIT_MS'] / 1000)
+            with self.lock:
+                self.batch = None
+            self.commit_batch(batch)
+        else:
+            slot['done'].wait()
+        if slot['error'] is not None:
+            raise slot['error']
+        if slot['result'] is None:
+            raise RuntimeError('the order was not written')
+        return slot['result']
+
+    # Runs in the leader's request and leaves a result or an error on every slot. An order
+    # failing validation (an HTTPException raised before create_order() changes anything)
+    # only fails itself. An order raising anything else may have changed the session, so
+    # it is rolled back and the rest of the batch is retried without that order. If the
+    # commit itself fails, every order in it fails.
+    def commit_batch(self, batch):
+        try:
+            remaining = batch
+            while remaining:
+                created = []
+                failed = False
+                for slot in remaining:
+                    try:
+                        created.append((slot, create_order(slot['data'])))
+                    except HTTPException as error:
+                        slot['error'] = error
+                    except Exception as error:
+                        self.app.logger.exception("adding an order failed")
+                        slot['error'] = error
+                        failed = True
+                        break
+                if failed:
+                    db.session.rollback()
+                    remaining = [slot for slot in remaining if slot['error'] is None]
+                    continue
+                try:
+                    db.session.commit()
+                except Exception as error:
+                    self.app.logger.exception("committing a batch of orders failed")
+                    db.session.rollback()
+                    for slot, order in created:
+                        slot['error'] = error
+                else:
+                    for slot, order in created:
+                        slot['result'] = order_schema.dump(order)
+                remaining = []
+        finally:
+            with self.lock:
+                self.stats['batches'] += 1
+                self.stats['batched_orders'] += len(batch)
+                self.stats['largest_batch'] = max(self.stats['largest_batch'], len(batch))
+            for slot in batch:
+                if slot['result'] is None and slot['error'] is None:
+                    slot['error'] = RuntimeError('the order was not written')
+                slot['done'].set()
+
+# One per worker, created on first use, after gevent has patched threading.
+def get_write_admission():
+    app = current_app._get_current_object()
+    if 'write_admission' not in app.extensions:
+        app.extensions['write_admission'] = WriteAdmission(app)
+    return app.extensions['write_admission']
+
+# Apply write admission to a write endpoint.
+def admitted(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        admission = get_write_admission()
+        rejected = admission.admit(request.remote_addr)
+        if rejected:
+            status, retry_after = rejected
+            message = 'too many writes, slow down' if status == 429 else 'server busy, try again'
+            response = jsonify(errors=[message])
+            response.status_code = status
+            response.headers['Retry-After'] = str(retry_after)
+            return response
+        try:
+            return view(*args, **kwargs)
+        finally:
+            admission.release()
+    return wrapper
+
+# This worker's admission counters, current writes in progress and tracked clients.
+@bp.route('/admission', methods=['GET'])
+def get_admission_stats():
+    admission = get_write_admission()
+    with admission.lock:
+        return jsonify(pending=admission.pending, clients=len(admission.buckets), **admission.stats)
+
 ##### MEMBER FUCTIONS #####
 # Add a member
-@app.route("/member", methods=['POST'])
+@bp.route("/member", methods=['POST'])
 def add_member():
     request_data = request.get_json()
     print(request_data)
@@ -201,7 +728,7 @@ def add_member():
 
 
 # Get all members
-@app.route('/member', methods=['GET'])
+@bp.route('/member', methods=['GET'])
 def get_members():
     # Check if there is any member in database, if no member, response a 404 page
     if Member.query.first_or_404():
@@ -210,7 +737,7 @@ def get_members():
         return jsonify(result)
 
 # Get all members by pagination
-@app.route('/member/page/<int:request_page>', methods=['GET'])
+@bp.route('/member/page/<int:request_page>', methods=['GET'])
 def get_members_paginate(request_page):
     # Check if there is any member in database, if no member, response a 404 page
     if Member.query.first_or_404():
@@ -224,7 +751,7 @@ def get_members_paginate(request_page):
 
 
 # Get a single member by id
-@app.route('/member/<int:id>', methods=['GET'])
+@bp.route('/member/<int:id>', methods=['GET'])
 def get_member(id):
     # Check if there is any member with this id in database, if no, response a 404 page
     if Member.query.filter_by(id=id).first_or_404():
@@ -233,7 +760,7 @@ def get_member(id):
 
 
 # Delete a member by member's id
-@app.route('/member/<id>', methods=['DELETE'])
+@bp.route('/member/<id>', methods=['DELETE'])
 def delete_member(id):
     # Check if there is any member with this in database, if no member, response a 404 page
     if Member.query.filter_by(id=id).first_or_404():
@@ -256,17 +783,31 @@ def update_member_monetary(member_id, amount):
     return member_to_update
 
 # Add an order
-@app.route("/order", methods=['POST'])
+@bp.route("/order", methods=['POST'])
+@admitted
 def add_order():
     request_data = request.get_json()
-    member_id = int(request_data['member_id'])
+    # Commits together with other orders arriving at the same time.
+    result = get_write_admission().submit_order(request_data)
+    return jsonify(result)
+
+# Add an order to the session, without committing. Every check runs (and may abort)
+# before anything is changed, so a rejected order leaves the session untouched.
+def create_order(request_data):
+    try:
+        member_id = int(request_data['member_id'])
+        total_amount = int(request_data['total_amount'])
+        date = datetime.strptime(request_data['date'], '%Y-%m-%d')
+        quantity = int(request_data['quantity'])
+        product_id = int(request_data['product_id'])
+    except (KeyError, TypeError, ValueError):
+        abort(400)
     # Check if there is any member with this order's member_id in database
     if Member.query.filter_by(id=member_id).first_or_404():
-        total_amount = request_data['total_amount']
-        date = request_data['date']
-        date = datetime.strptime(date, '%Y-%m-%d')
-        quantity = request_data['quantity']
-        product_id = request_data['product_id']
+        Product.query.get_or_404(product_id)
+        # Archived years are read-only.
+        if Order_Archive.query.get(date.year):
+            abort(make_response(jsonify(errors=[f'{date.year} is archived']), 400))
 
         new_order = Order(total_amount, member_id, date, quantity, product_id)
         db.session.add(new_order)
@@ -274,7 +815,7 @@ def add_order():
         ### Update product simultaneously. ###
         # update product's on hand balance.
         updated_product = Product.query.filter_by(product_id=product_id).first()
-        updated_product.on_hand_balance -= request_data['quantity']
+        updated_product.on_hand_balance -= quantity
 
         db.session.add(updated_product)
         db.session.add(new_order)
@@ -282,13 +823,13 @@ def add_order():
 
         # When add an order, update member's monetary
         db.session.add(update_member_monetary(member_id, total_amount))
-        update_season_sale()
+        update_season_sale(date.year)
+        bump_version('product', 'season_sale')
+        record_stock_event('product', updated_product)
+        return new_order
 
-        db.session.commit()
-        return order_schema.jsonify(new_order)
-
-# Get all orders
-@app.route('/order', methods=['GET'])
+# Get all orders (archived years are not listed, see archive-orders)
+@bp.route('/order', methods=['GET'])
 def get_orders():
     # Check if there is any order in database, if no order, response a 404 page
     if Order.query.first_or_404():
@@ -297,7 +838,7 @@ def get_orders():
         return jsonify(result)
 
 # Get all single member's orders
-@app.route('/order/mid=<int:member_id>', methods=['GET'])
+@bp.route('/order/mid=<int:member_id>', methods=['GET'])
 def get_a_member_orders(member_id):
     # Check if there is any order in database, if no order, response a 404 page
     if Order.query.filter_by(member_id=member_id).first_or_404():
@@ -306,7 +847,7 @@ def get_a_member_orders(member_id):
         return jsonify(result)
 
 # Get members by pagination
-@app.route('/order/page/<int:request_page>', methods=['GET'])
+@bp.route('/order/page/<int:request_page>', methods=['GET'])
 def get_orders_paginate(request_page):
     # Check if there is any order in database, if no order, response a 404 page
     if Order.query.first_or_404():
@@ -318,7 +859,7 @@ def get_orders_paginate(request_page):
         return jsonify(result)
 
 # Get a single order by order's id
-@app.route('/order/<id>', methods=['GET'])
+@bp.route('/order/<id>', methods=['GET'])
 def get_order(id):
     # Check if there is any order with this id in database, if no, response a 404 page
     if Order.query.filter_by(order_id=id).first_or_404():
@@ -326,7 +867,8 @@ def get_order(id):
         return order_schema.jsonify(order)
 
 # Delete a order by id
-@app.route('/order/<id>', methods=['DELETE'])
+@bp.route('/order/<id>', methods=['DELETE'])
+@admitted
 def delete_order(id):
     # Check if there is any order with this id in database, if no, response a 404 page
     if Order.query.filter_by(order_id=id).first_or_404():
@@ -339,68 +881,84 @@ def delete_order(id):
         product.on_hand_balance += order_to_delete.quantity
 
         db.session.delete(order_to_delete)
+        db.session.flush()
         # When delete an order, update member's monetary
         update_member_monetary(order_to_delete.member_id, amount)
+        update_season_sale(order_to_delete.date.year)
+        bump_version('product', 'season_sale')
+        record_stock_event('product', product)
         db.session.commit()
         return order_schema.jsonify(order_to_delete)
 
 ##### PRODUCT FUNCTIONS #####
+# The BOM is only sent when asked for with ?include=materials.
+def include_materials():
+    return 'materials' in request.args.get('include', '').split(',')
+
+# Query products, loading their materials in one extra SELECT only when the BOM is needed.
+def product_query(with_materials):
+    if with_materials:
+        return Product.query.options(selectinload(Product.product_material_relation))
+    return Product.query
+
+# Dump products, adding each product's material ids when the BOM was requested.
+def dump_products(products, with_materials):
+    result = products_schema.dump(products)
+    if with_materials:
+        for product_data, product in zip(result, products):
+            product_data['materials'] = [material.material_id for material in product.product_material_relation]
+    return result
+
 # Get all products.
-@app.route('/products')
+@bp.route('/products')
+@conditional('product')
 def get_products():
     if Product.query.first_or_404():
-        all_products = Product.query.all()
-        result = products_schema.dump(all_products)
-
-        for i in range(3):
-            del result[i]['product_material_relation']
-
+        with_materials = include_materials()
+        all_products = product_query(with_materials).all()
+        result = dump_products(all_products, with_materials)
         return jsonify(result)
 
 # Get products paginate.
-@app.route('/products/page/<int:request_page>')
+@bp.route('/products/page/<int:request_page>')
+@conditional('product')
 def get_products_paginate(request_page):
     if Product.query.first_or_404():
-        pages = Product.query.paginate(request_page, 10, False)
+        with_materials = include_materials()
+        pages = product_query(with_materials).paginate(request_page, 10, False)
         # 如果要求的頁數多於所有的頁數，回傳404
         if pages.page > pages.pages:
             abort(404)
-        result = products_schema.dump(pages.items)
-
-        for i in range(3):
-            del result[i]['product_material_relation']
-
+        result = dump_products(pages.items, with_materials)
         return jsonify(result)
 
 # Get certain product by product_id.
-@app.route('/product/<int:product_id>/edit', methods=['GET'])
+@bp.route('/product/<int:product_id>/edit', methods=['GET'])
+@conditional('product')
 def get_product(product_id):
     if Product.query.first_or_404():
-        product = Product.query.get(product_id)
-        result = product_schema.dump(product)
-
-        del result['product_material_relation']
-
+        with_materials = include_materials()
+        product = product_query(with_materials).get_or_404(product_id)
+        result = dump_products([product], with_materials)[0]
         return jsonify(result)
 
 ##### REORDER POINT FUNCTIONS #####
 # Get all material and product list.
-@app.route('/inventory', methods=['GET'])
+@bp.route('/inventory', methods=['GET'])
+@conditional('product', 'material')
 def get_inventory():
     if Product.query.first_or_404():
         if Material.query.first_or_404():
-            all_products = Product.query.all()
+            with_materials = include_materials()
+            all_products = product_query(with_materials).all()
             all_materials = Material.query.all()
-            products = products_schema.dump(all_products)
-
-            for i in range(3):
-                del products[i]['product_material_relation']
-
+            products = dump_products(all_products, with_materials)
             materials = materials_schema.dump(all_materials)
             return jsonify(products=products, materials=materials)
 
 # Update all material and product.
-@app.route('/inventory', methods=['PUT'])
+@bp.route('/inventory', methods=['PUT'])
+@admitted
 def update_inventory():
     request_data = request.get_json()
     updated_products = []
@@ -423,6 +981,12 @@ def update_inventory():
             updated_materials.append(material)
     materials = materials_schema.dump(updated_materials)
 
+    bump_version('product', 'material')
+    # Changing a reorder point can put an item below it.
+    for product in updated_products:
+        record_stock_event('product', product)
+    for material in updated_materials:
+        record_stock_event('material', material)
     db.session.commit()
 
     return jsonify(products=products, materials=materials)
@@ -430,9 +994,10 @@ def update_inventory():
 
 # seasonal seasonal_predict
 def seasonal_predict():
-    order = Order.query.all()
-
     today = datetime.today()
+    # Only this year's and last year's quarters are used.
+    order = Order.query.filter(Order.date >= datetime(year=today.year-1, month=1, day=1)).all()
+
     orders_quaters = {1:[], 2:[], 3:[], 4:[]}
     if today > datetime(year=today.year, month=10, day=1):
         for order in order:
@@ -501,7 +1066,7 @@ def seasonal_predict():
     return quaters_quantity, predict_quantity
 
 # Order seasonal_predict using seasonal additive method.
-@app.route('/order/predict', methods=['GET'])
+@bp.route('/order/predict', methods=['GET'])
 def seasonal_predict_result():
     if Order.query.first_or_404():
         quaters_quantity, predict_quantity = seasonal_predict()
@@ -509,11 +1074,13 @@ def seasonal_predict_result():
 
 ##### MRP FUNCTIONS #####
 
-@app.route('/mrp', methods=['GET'])
+@bp.route('/mrp', methods=['GET'])
+@conditional('product', 'material')
 def get_mrp():
     mmrelations = Material_Material.query.all()
     materials = Material.query.all()
-    products = Product.query.all()
+    # The plan walks every product's BOM, so load it up front.
+    products = product_query(True).all()
 
     product_material_dict = {}
     for product in products:
@@ -581,7 +1148,7 @@ def get_mrp():
 
 ##### MARKETING METRTICS - SEASON_SALE FUNCTIONS #####
 # Add a season_sale
-@app.route("/ssale", methods=['POST'])
+@bp.route("/ssale", methods=['POST'])
 def add_season_sale():
     request_data = request.get_json()
     print(request_data)
@@ -591,13 +1158,15 @@ def add_season_sale():
 
     new_season_sale = Season_Sale(year, season, sale)
     db.session.add(new_season_sale)
+    bump_version('season_sale')
     db.session.commit()
 
     return season_sale_schema.jsonify(new_season_sale)
 
 
 # Get all season_sales
-@app.route('/ssale', methods=['GET'])
+@bp.route('/ssale', methods=['GET'])
+@conditional('season_sale')
 def get_season_sales():
     # Check if there is any season_sale in database, if no, response a 404 page
     if Season_Sale.query.first_or_404():
@@ -607,7 +1176,8 @@ def get_season_sales():
 
 
 # Get a single season_sale by year and season
-@app.route('/ssale/<int:year>/<int:season>', methods=['GET'])
+@bp.route('/ssale/<int:year>/<int:season>', methods=['GET'])
+@conditional('season_sale')
 def get_season_sale(year, season):
     # Check if there is any season_sale in this year and season in database, if no, response a 404 page
     if Season_Sale.query.filter_by(year=year, season=season).first_or_404():
@@ -617,7 +1187,8 @@ def get_season_sale(year, season):
 
 
 # Get all season_sales in single year by year
-@app.route('/ssale/year/<int:year>', methods=['GET'])
+@bp.route('/ssale/year/<int:year>', methods=['GET'])
+@conditional('season_sale')
 def get_season_sales_by_year(year):
     # Check if there is any season_sale in this year in database, if no, response a 404 page
     if Season_Sale.query.filter_by(year=year).first_or_404():
@@ -627,7 +1198,8 @@ def get_season_sales_by_year(year):
 
 
 # Get all season_sales in single season by season
-@app.route('/ssale/season/<int:season>', methods=['GET'])
+@bp.route('/ssale/season/<int:season>', methods=['GET'])
+@conditional('season_sale')
 def get_season_sales_by_season(season):
     # Check if there is any season_sale in this season in database, if no, response a 404 page
     if Season_Sale.query.filter_by(season=season).first_or_404():
@@ -638,7 +1210,8 @@ def get_season_sales_by_season(season):
 
 
 # Get all quarter on quarter data
-@app.route('/ssale/qoq', methods=['GET'])
+@bp.route('/ssale/qoq', methods=['GET'])
+@conditional('season_sale')
 def cal_qoq():
     sale_data = []
     if Season_Sale.query.first_or_404():
@@ -665,58 +1238,74 @@ def cal_qoq():
 
 
 # Update a season_sale
-def update_season_sale():
+# Recompute one year's four Season_Sale rows from that year's orders. The date range
+# uses the order date index, so the cost doesn't grow with older history, and archived
+# years (see archive-orders) keep the totals they had when they were closed.
+def update_season_sale(year):
     print("update season sale")
-    result =[]
-    for year in range(2019, 2022):
-        for season in range(1, 5):
-            a_season_data ={
-                "year": year,
-                "season": season,
-                "sale": 0
-            }
-            result.append(a_season_data)
-    print(result)
-    if Order.query.first_or_404():
-        all_orders = Order.query.all()
-        for order in all_orders:
-            if order.date.year == 2019:
-                if 1 <= order.date.month <= 3:
-                    result[0]['sale'] += order.total_amount
-                elif 4 <= order.date.month <= 6:
-                    result[1]['sale'] += order.total_amount
-                elif 7 <= order.date.month <= 9:
-                    result[2]['sale'] += order.total_amount
-                elif 10 <= order.date.month <= 12:
-                    result[3]['sale'] += order.total_amount
-            elif order.date.year == 2020:
-                if 1 <= order.date.month <= 3:
-                    result[4]['sale'] += order.total_amount
-                elif 4 <= order.date.month <= 6:
-                    result[5]['sale'] += order.total_amount
-                elif 7 <= order.date.month <= 9:
-                    result[6]['sale'] += order.total_amount
-                elif 10 <= order.date.month <= 12:
-                    result[7]['sale'] += order.total_amount
-            elif order.date.year == 2021:
-                if 1 <= order.date.month <= 3:
-                    result[8]['sale'] += order.total_amount
-                elif 4 <= order.date.month <= 6:
-                    result[9]['sale'] += order.total_amount
-                elif 7 <= order.date.month <= 9:
-                    result[10]['sale'] += order.total_amount
-                elif 10 <= order.date.month <= 12:
-                    result[11]['sale'] += order.total_amount
-        print(result)
-        index = 0
-        for year in range(2019, 2022):
-            for season in range(1, 5):
-                ssale_to_update = Season_Sale.query.filter(Season_Sale.year == year, Season_Sale.season == season).first()
-                ssale_to_update.sale = result[index]['sale']
-                index += 1
+    orders = db.session.query(Order.date, Order.total_amount).filter(
+        Order.date >= datetime(year, 1, 1), Order.date < datetime(year + 1, 1, 1)).all()
+    sales = {1: 0, 2: 0, 3: 0, 4: 0}
+    for date, total_amount in orders:
+        sales[(date.month - 1) // 3 + 1] += total_amount
+    for season, sale in sales.items():
+        ssale_to_update = Season_Sale.query.get((year, season))
+        if ssale_to_update is None:
+            db.session.add(Season_Sale(year, season, sale))
+        else:
+            ssale_to_update.sale = sale
+
+##### ORDER ARCHIVE #####
+# Orders of closed years are moved out of the "order" table into archived_order, in the
+# same database, so queries on recent orders stay as fast however much history there is.
+# /rfm and /analytics/batch read them back; the /order endpoints only list the orders
+# still in the table. Only years older than the two years /repurchase-rate and
+# /active-rate look back on can be archived.
+
+# Conditions on a date column for [first_year, last_year], None: unbounded.
+def in_years(column, first_year=None, last_year=None):
+    conditions = []
+    if first_year is not None:
+        conditions.append(column >= datetime(first_year, 1, 1))
+    if last_year is not None:
+        conditions.append(column < datetime(last_year + 1, 1, 1))
+    return conditions
+
+# (member_id, date, total_amount) of the archived orders dated in [first_year, last_year].
+def load_archived_orders(first_year=None, last_year=None):
+    return db.session.query(Archived_Order.member_id, Archived_Order.date, Archived_Order.total_amount).filter(
+        *in_years(Archived_Order.date, first_year, last_year)).all()
+
+# Close a past year: freeze its Season_Sale totals and move its orders from the order
+# table to archived_order, in one transaction.
+#   flask archive-orders 2019
+@click.command('archive-orders')
+@click.argument('year', type=int)
+@with_appcontext
+def archive_orders_command(year):
+    if datetime(year + 1, 1, 1) > datetime.today() - timedelta(days=730):
+        raise click.ClickException('only years that ended more than two years ago can be archived')
+    if Order_Archive.query.get(year):
+        raise click.ClickException(f'{year} is already archived')
+
+    in_year = in_years(Order.date, year, year)
+    update_season_sale(year)
+    orders, total_amount = db.session.query(
+        func.count(Order.order_id), func.coalesce(func.sum(Order.total_amount), 0)).filter(*in_year).one()
+
+    table = Order.__table__
+    columns = [column.name for column in Archived_Order.__table__.columns]
+    db.session.execute(Archived_Order.__table__.insert().from_select(
+        columns, select(*[table.c[name] for name in columns]).where(*in_year)))
+    db.session.add(Order_Archive(year, orders, total_amount))
+    db.session.execute(table.delete().where(*in_year))
+    bump_version('season_sale')
+    db.session.commit()
+    click.echo(f'Archived {orders} orders of {year}.')
+
 ##### 顧客活動指標 #####
 # 回購率
-@app.route('/repurchase-rate', methods=['GET'])
+@bp.route('/repurchase-rate', methods=['GET'])
 def cal_repurchase_rate():
     one_year_ago = datetime.today() - timedelta(days = 365)
     two_year_ago = datetime.today() - timedelta(days = 730)
@@ -735,7 +1324,7 @@ def cal_repurchase_rate():
         return jsonify(result)
 
 # 活躍率
-@app.route('/active-rate', methods=['GET'])
+@bp.route('/active-rate', methods=['GET'])
 def cal_active_rate():
     one_year_ago = datetime.today() - timedelta(days = 365)
     result = []
@@ -765,45 +1354,464 @@ def cal_active_rate():
         result.append(result_list)
     return jsonify(result)
 
-@app.route('/rfm', methods=['GET'])
+# Over all orders, archived years included, ranked by the stored Member.monetary.
+@bp.route('/rfm', methods=['GET'])
 def cal_rfm():
-    if Order.query.first_or_404():
-        #M
-        counts = Order.query.group_by(Order.member_id).count()
-        selected_member_id = []
-        members = Member.query.order_by(desc(Member.monetary)).limit((counts+1)/2).all()
-        for member in members:
-            selected_member_id.append(member.id)
-        print(selected_member_id)
-
-        #F
-        freq_dict = {}
-        for member_id in selected_member_id:
-            count = Order.query.filter(Order.member_id==member_id).count()
-            freq_dict[member_id] = count
-        freq_list = sorted(freq_dict.items(), reverse=True, key=lambda x:x[1])
-        member_id_list = freq_list[:int((len(selected_member_id)+1)/2)]
-        selected_member_id = []
-        for i in range(len(member_id_list)):
-            selected_member_id.append(member_id_list[i][0])
-        print(selected_member_id)
-
-        #R(負的)
-        rect_dict = {}
-        for member_id in selected_member_id:
-            order = Order.query.filter(Order.member_id==member_id).order_by(desc(Order.date)).first()
-            rect_dict[member_id] = order.date
-        rect_list = sorted(rect_dict.items(), key=lambda x:x[1])
-        member_id_list = rect_list[:int((len(selected_member_id)+1)/2)]
-        result_id_list = [member[0] for member in member_id_list]
-        members = Member.query.filter(Member.id.in_(result_id_list)).all()
-        result = members_schema.dump(members)
-        return jsonify(result)
+    member_ids, members, dates, amounts = load_order_arrays()
+    if not members.size:
+        abort(404)
+    monetary_by_id = dict(db.session.query(Member.id, Member.monetary))
+    monetary = np.array([monetary_by_id.get(member_id, 0) for member_id in member_ids.tolist()])
+    selected = rfm_snapshot(len(member_ids), members, dates, amounts, monetary)
+    members = Member.query.filter(Member.id.in_(member_ids[selected].tolist())).all()
+    result = members_schema.dump(members)
+    return jsonify(result)
 
 
 
+##### BATCH ANALYTICS #####
+# The /rfm, /active-rate and /repurchase-rate metrics evaluated at any as_of date, for
+# many dates at once. Orders are loaded once into numpy arrays; each snapshot then only
+# looks at the orders up to its as_of date. Unlike /rfm, which ranks by the stored
+# Member.monetary, a snapshot ranks by the sum of the member's orders up to as_of.
+analytics_metrics = ('rfm', 'active-rate', 'repurchase-rate')
+
+DAY = 86400 * 10**6  # in microseconds, the unit of the date arrays
+
+# Orders dated in [first_year, last_year] (None: unbounded), including archived years,
+# as arrays sorted by date: member index (into member_ids), date, total_amount.
+def load_order_arrays(first_year=None, last_year=None):
+    member_ids = np.array([row.id for row in db.session.query(Member.id).order_by(Member.id)], dtype=np.int64)
+    rows = db.session.query(Order.member_id, Order.date, Order.total_amount).filter(
+        *in_years(Order.date, first_year, last_year)).all()
+    rows += load_archived_orders(first_year, last_year)
+    order_members = np.array([row.member_id for row in rows], dtype=np.int64)
+    dates = np.array([row.date for row in rows], dtype='datetime64[us]').astype(np.int64)
+    amounts = np.array([row.total_amount for row in rows], dtype=np.int64)
+    by_date = np.argsort(dates, kind='stable')
+    order_members, dates, amounts = order_members[by_date], dates[by_date], amounts[by_date]
+
+    # Drop orders of deleted members, then map member ids to positions in member_ids.
+    known = np.isin(order_members, member_ids)
+    members = np.searchsorted(member_ids, order_members[known])
+    return member_ids, members, dates[known], amounts[known]
+
+def repurchase_snapshot(n_members, members, dates, as_of):
+    one_year_ago = as_of - 365 * DAY
+    two_year_ago = as_of - 730 * DAY
+    last_year = np.unique(members[(dates >= two_year_ago) & (dates <= one_year_ago)])
+    if not last_year.size:
+        return None
+    bought_again = np.zeros(n_members, dtype=bool)
+    bought_again[members[dates >= one_year_ago]] = True
+    return float(bought_again[last_year].mean())
+
+def active_snapshot(n_members, members, dates, as_of):
+    one_year_ago = as_of - 365 * DAY
+    recent = dates >= one_year_ago
+    count = np.bincount(members[recent], minlength=n_members)
+    latest = np.full(n_members, one_year_ago, dtype=np.int64)
+    np.maximum.at(latest, members[recent], dates[recent])
+    months_ago_purchase = np.where(count > 0, np.round((as_of - latest) // DAY / 30, 2), 0)
+    active_rate = np.where(count > 0, np.round(((12 - months_ago_purchase) / 12) ** count, 4), 0)
+    return count, months_ago_purchase, active_rate
+
+# The three halvings of /rfm: top half of buyers by monetary, then half of those by
+# frequency, then half of those by recency (least recent first). Returns member indexes.
+# monetary defaults to the sum of the given orders per member.
+def rfm_snapshot(n_members, members, dates, amounts, monetary=None):
+    if monetary is None:
+        monetary = np.bincount(members, weights=amounts, minlength=n_members)
+    frequency = np.bincount(members, minlength=n_members)
+    latest = np.full(n_members, np.iinfo(np.int64).min, dtype=np.int64)
+    np.maximum.at(latest, members, dates)
+
+    # Ties keep member id order, like the SQL ORDER BY in /rfm.
+    selected = np.argsort(-monetary, kind='stable')[:(np.count_nonzero(frequency) + 1) // 2]
+    selected = selected[np.argsort(-frequency[selected], kind='stable')][:(len(selected) + 1) // 2]
+    selected = selected[np.argsort(latest[selected], kind='stable')][:(len(selected) + 1) // 2]
+    return np.sort(selected)
+
+# Evaluate the metrics at each as_of date (microsecond timestamps). Module level so a
+# process pool can run it on a slice of the dates.
+def analytics_sweep(member_ids, members, dates, amounts, as_of_dates, metrics):
+    n_members = len(member_ids)
+    columns = {'repurchase_rate': [],
+               'rfm': {'as_of': [], 'member_id': []},
+               'active_rate': {'as_of': [], 'member_id': [], 'purchase_time': [],
+                               'months_ago_purchase': [], 'active_rate': []}}
+    for as_of in as_of_dates:
+        end = np.searchsorted(dates, as_of, side='right')
+        snapshot = members[:end], dates[:end]
+        if 'repurchase-rate' in metrics:
+            columns['repurchase_rate'].append(repurchase_snapshot(n_members, *snapshot, as_of))
+        if 'active-rate' in metrics:
+            count, months_ago_purchase, active_rate = active_snapshot(n_members, *snapshot, as_of)
+            columns['active_rate']['as_of'].append(np.full(n_members, as_of))
+            columns['active_rate']['member_id'].append(member_ids)
+            columns['active_rate']['purchase_time'].append(count)
+            columns['active_rate']['months_ago_purchase'].append(months_ago_purchase)
+            columns['active_rate']['active_rate'].append(active_rate)
+        if 'rfm' in metrics:
+            selected = rfm_snapshot(n_members, *snapshot, amounts[:end])
+            columns['rfm']['as_of'].append(np.full(len(selected), as_of))
+            columns['rfm']['member_id'].append(member_ids[selected])
+    return columns
+
+# One pool per worker, started on first use and reused by every request. spawn, not
+# fork: forking a threaded (or gevent) worker is unsafe.
+def get_analytics_pool():
+    app = current_app._get_current_object()
+    if 'analytics_pool' not in app.extensions:
+        app.extensions['analytics_pool'] = ProcessPoolExecutor(
+            app.config['ANALYTICS_PROCESSES'], mp_context=multiprocessing.get_context('spawn'))
+    return app.extensions['analytics_pool']
+
+# Join the sweeps of consecutive date slices into one flat array per column, keeping only the requested metrics.
+def merge_sweeps(sweeps, metrics):
+    result = {}
+    if 'repurchase-rate' in metrics:
+        result['repurchase_rate'] = np.array([np.nan if rate is None else rate
+                                              for sweep in sweeps for rate in sweep['repurchase_rate']])
+    for metric in ('rfm', 'active-rate'):
+        if metric in metrics:
+            key = metric.replace('-', '_')
+            result[key] = {name: np.concatenate([part for sweep in sweeps for part in sweep[key][name]] or [[]])
+                           for name in sweeps[0][key]}
+            # Timestamps back to the YYYY-MM-DD the client sent.
+            result[key]['as_of'] = np.datetime_as_string(result[key]['as_of'].astype('datetime64[us]'), unit='D')
+    return result
+
+# Compute /rfm, /active-rate and /repurchase-rate for many snapshots in one call.
+# Body: {"as_of": ["2021-01-01", ...], "metrics": ["rfm", ...]} (metrics default to all).
+# The result is columnar: one list per field, with as_of repeated on every row.
+# ?format=npz returns the same columns as a numpy archive, named e.g. "active_rate.member_id".
+@bp.route('/analytics/batch', methods=['POST'])
+def analytics_batch():
+    request_data = request.get_json()
+    try:
+        as_of_dates = [datetime.strptime(as_of, '%Y-%m-%d') for as_of in request_data['as_of']]
+    except (KeyError, TypeError, ValueError):
+        return jsonify(errors=['as_of must be a list of YYYY-MM-DD dates']), 400
+    if not as_of_dates:
+        return jsonify(errors=['as_of must list at least one date']), 400
+    metrics = request_data.get('metrics', analytics_metrics)
+    if not isinstance(metrics, (list, tuple)) or not all(isinstance(metric, str) for metric in metrics):
+        return jsonify(errors=['metrics must be a list of metric names']), 400
+    unknown = [metric for metric in metrics if metric not in analytics_metrics]
+    if unknown:
+        return jsonify(errors=[f'unknown metric {metric!r}' for metric in unknown]), 400
+
+    # rfm ranks by lifetime spend, the other metrics look back at most two years.
+    first_year = None if 'rfm' in metrics else (min(as_of_dates) - timedelta(days=730)).year
+    order_arrays = load_order_arrays(first_year, max(as_of_dates).year)
+    as_of_values = np.array(as_of_dates, dtype='datetime64[us]').astype(np.int64)
+    processes = min(current_app.config['ANALYTICS_PROCESSES'], len(as_of_values))
+    if processes > 1:
+        pool = get_analytics_pool()
+        try:
+            futures = [pool.submit(analytics_sweep, *order_arrays, part, metrics)
+                       for part in np.array_split(as_of_values, processes)]
+            sweeps = [future.result() for future in futures]
+        except BrokenProcessPool:
+            # A pool process died; start a fresh pool for the next request.
+            current_app.extensions.pop('analytics_pool', None)
+            raise
+    else:
+        sweeps = [analytics_sweep(*order_arrays, as_of_values, metrics)]
+    result = merge_sweeps(sweeps, metrics)
+    result['as_of'] = np.datetime_as_string(as_of_values.astype('datetime64[us]'), unit='D')
+
+    # Flatten to "active_rate.member_id" style names for the archive.
+    if request.args.get('format') == 'npz':
+        arrays = {}
+        for key, value in result.items():
+            if isinstance(value, dict):
+                arrays.update({f'{key}.{name}': values for name, values in value.items()})
+            else:
+                arrays[key] = value
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **arrays)
+        return current_app.response_class(buffer.getvalue(), mimetype='application/octet-stream')
+
+    if 'repurchase_rate' in result:
+        # No buyers in the earlier year: null, where /repurchase-rate answers 404.
+        result['repurchase_rate'] = [None if np.isnan(rate) else rate for rate in result['repurchase_rate'].tolist()]
+    for key, value in result.items():
+        if isinstance(value, dict):
+            result[key] = {name: values.tolist() for name, values in value.items()}
+        elif isinstance(value, np.ndarray):
+            result[key] = value.tolist()
+    return jsonify(result)
+
+##### BULK IMPORT / EXPORT #####
+# Master data that can be loaded in bulk: the table, the columns identifying a row
+# (rows with the same key are updated), values for columns a file may leave out (only
+# used for new rows, existing rows keep theirs, e.g. a member's order-derived monetary),
+# and the cached resource (see conditional()) that changes with it.
+bulk_entities = {
+    'members': {'table': Member.__table__, 'key': ('id',), 'defaults': {'monetary': 0}, 'resource': None},
+    'products': {'table': Product.__table__, 'key': ('product_id',), 'defaults': {}, 'resource': 'product'},
+    'materials': {'table': Material.__table__, 'key': ('material_id',), 'defaults': {}, 'resource': 'material'},
+    'product_material': {'table': product_material_relation, 'key': ('product_id', 'material_id'),
+                         'defaults': {}, 'resource': 'product'},
+    'material_material': {'table': Material_Material.__table__, 'key': ('material_id', 'raw_material_id'),
+                          'defaults': {}, 'resource': 'material'},
+}
+
+# numpy dtype used for each column type in .npz exports.
+npz_dtypes = {int: np.int64, float: np.float64, str: np.str_, datetime: 'datetime64[us]'}
+
+class BulkImportError(Exception):
+    def __init__(self, errors):
+        super().__init__('\n'.join(errors))
+        self.errors = errors
+
+# Check and convert one input row. A missing single-column key means "new row", the database assigns the id.
+def validate_row(entity, row):
+    if None in row:
+        # csv.DictReader files the values past the header under None.
+        raise ValueError('more values than columns')
+    values = {}
+    for column in entity['table'].columns:
+        value = row.get(column.name)
+        if value is None or value == '':
+            if entity['key'] == (column.name,):
+                continue
+            if column.name in entity['defaults']:
+                values[column.name] = entity['defaults'][column.name]
+                continue
+            raise ValueError(f'missing {column.name}')
+        try:
+            values[column.name] = column.type.python_type(value)
+        except (TypeError, ValueError):
+            raise ValueError(f'invalid {column.name}: {value!r}')
+        length = getattr(column.type, 'length', None)
+        if length and len(values[column.name]) > length:
+            raise ValueError(f'{column.name} is longer than {length} characters')
+    return values
+
+# Write one chunk of validated rows with at most three bulk statements. Returns the
+# number of rows inserted or updated.
+def write_chunk(entity, rows):
+    table = entity['table']
+    key = entity['key']
+    new_rows = [row for row in rows if key[0] not in row]
+    # Last row wins when a key repeats within the chunk.
+    keyed_rows = list({tuple(row[k] for k in key): row for row in rows if key[0] in row}.values())
+
+    if new_rows:
+        db.session.execute(table.insert(), new_rows)
+    if not keyed_rows:
+        return len(new_rows)
+
+    update_columns = [column.name for column in table.columns
+                      if column.name not in key and column.name not in entity['defaults']]
+    if not table.primary_key or not update_columns:
+        # Nothing to update on a row that exists (an association table has no unique
+        # constraint to upsert on either): only add the keys that are missing.
+        existing = set(db.session.execute(
+            select(*[table.c[k] for k in key]).where(table.c[key[0]].in_({row[key[0]] for row in keyed_rows}))))
+        keyed_rows = [row for row in keyed_rows if tuple(row[k] for k in key) not in existing]
+        if not keyed_rows:
+            return len(new_rows)
+        if not table.primary_key:
+            db.session.execute(table.insert(), keyed_rows)
+            return len(new_rows) + len(keyed_rows)
+
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        statement = postgresql.insert(table)
+    elif dialect == 'sqlite':
+        statement = sqlite.insert(table)
+    else:
+        raise BulkImportError([f'bulk import is not supported on {dialect}'])
+    if update_columns:
+        statement = statement.on_conflict_do_update(
+            index_elements=key, set_={name: statement.excluded[name] for name in update_columns})
+    else:
+        # A concurrent import may have added the key since the check above.
+        statement = statement.on_conflict_do_nothing(index_elements=key)
+    db.session.execute(statement, keyed_rows)
+    return len(new_rows) + len(keyed_rows)
+
+# Validate and upsert rows chunk by chunk in a single transaction. Nothing is written
+# if any row is invalid; the first 20 problems are reported. Returns the number of rows
+# written, which leaves out pairs a BOM table already has.
+def import_rows(entity_name, rows):
+    entity = bulk_entities[entity_name]
+    chunk_size = current_app.config['IMPORT_CHUNK_SIZE']
+    errors = []
+    chunk = []
+    count = 0
+    try:
+        for number, row in enumerate(rows, start=1):
+            try:
+                chunk.append(validate_row(entity, row))
+            except ValueError as error:
+                errors.append(f'row {number}: {error}')
+                if len(errors) >= 20:
+                    break
+            if len(chunk) >= chunk_size:
+                if not errors:
+                    count += write_chunk(entity, chunk)
+                chunk = []
+        if errors:
+            raise BulkImportError(errors)
+        count += write_chunk(entity, chunk)
+
+        table = entity['table']
+        if db.engine.dialect.name == 'postgresql' and len(entity['key']) == 1:
+            # Explicit ids don't advance the serial sequence, move it past them.
+            db.session.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('\"{table.name}\"', '{entity['key'][0]}'), "
+                f"COALESCE(MAX({entity['key'][0]}), 1)) FROM \"{table.name}\""))
+        if entity['resource']:
+            bump_version(entity['resource'])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return count
+
+# Column names and rows of a columnar .npz file (one array per column), as written by export_npz().
+def read_npz(file):
+    if not file.seekable():
+        file = io.BytesIO(file.read())
+    try:
+        with np.load(file, allow_pickle=False) as arrays:
+            names = arrays.files
+            columns = []
+            for name in names:
+                if arrays[name].ndim != 1:
+                    raise ValueError(f'{name} is not a 1-d array')
+                columns.append(arrays[name].tolist())
+    except (OSError, ValueError, zipfile.BadZipFile) as error:
+        raise BulkImportError([f'not a valid .npz file: {error}'])
+    if len({len(column) for column in columns}) > 1:
+        raise BulkImportError(['the .npz columns differ in length'])
+    return names, (dict(zip(names, values)) for values in zip(*columns))
+
+# A file may leave out columns that have a default, but not name columns the table lacks.
+def check_columns(entity_name, names):
+    known = {column.name for column in bulk_entities[entity_name]['table'].columns}
+    unknown = [name for name in names if name not in known]
+    if unknown:
+        raise BulkImportError([f'unknown column {name!r}' for name in unknown])
+
+# Import a binary file object in "csv" (header row with column names) or "npz" format.
+def import_file(entity_name, file, file_format):
+    if file_format == 'csv':
+        # Decoded line by line: uploads may be file objects io.TextIOWrapper can't wrap
+        # (SpooledTemporaryFile has no readable() before Python 3.11).
+        rows = csv.DictReader(codecs.iterdecode(file, 'utf-8-sig'))
+        try:
+            check_columns(entity_name, rows.fieldnames or [])
+            return import_rows(entity_name, rows)
+        except UnicodeDecodeError:
+            raise BulkImportError(['the file is not valid UTF-8 text'])
+        except csv.Error as error:
+            raise BulkImportError([f'line {rows.line_num}: {error}'])
+    if file_format == 'npz':
+        names, rows = read_npz(file)
+        check_columns(entity_name, names)
+        return import_rows(entity_name, rows)
+    raise BulkImportError([f'unsupported format {file_format!r}'])
+
+def export_query(entity):
+    table = entity['table']
+    return select(table).order_by(*[table.c[k] for k in entity['key']])
+
+# CSV text in chunks, streamed straight from the database cursor.
+def export_csv(entity_name):
+    entity = bulk_entities[entity_name]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([column.name for column in entity['table'].columns])
+    result = db.session.execute(export_query(entity).execution_options(stream_results=True))
+    for rows in result.partitions(current_app.config['IMPORT_CHUNK_SIZE']):
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+# Write rows to a compressed .npz file holding one typed array per column.
+def write_npz(columns, rows, file):
+    values = list(zip(*rows)) if rows else [()] * len(columns)
+    arrays = {column.name: np.array(column_values, dtype=npz_dtypes[column.type.python_type])
+              for column, column_values in zip(columns, values)}
+    np.savez_compressed(file, **arrays)
+
+def export_npz(entity_name, file):
+    entity = bulk_entities[entity_name]
+    write_npz(list(entity['table'].columns), db.session.execute(export_query(entity)).all(), file)
+
+# Bulk load members, products, materials or BOM relations. Send the file as the request
+# body or as the "file" field of a form; ?format=csv (default) or ?format=npz.
+@bp.route('/import/<entity>', methods=['POST'])
+def import_entity(entity):
+    if entity not in bulk_entities:
+        abort(404)
+    if request.mimetype == 'multipart/form-data':
+        if 'file' not in request.files:
+            abort(400)
+        file = request.files['file'].stream
+    else:
+        file = request.stream
+    try:
+        count = import_file(entity, file, request.args.get('format', 'csv'))
+    except BulkImportError as error:
+        return jsonify(errors=error.errors), 400
+    return jsonify(entity=entity, imported=count)
+
+# Dump an entity as CSV (default) or, with ?format=npz, as columnar numpy arrays.
+@bp.route('/export/<entity>', methods=['GET'])
+def export_entity(entity):
+    if entity not in bulk_entities:
+        abort(404)
+    file_format = request.args.get('format', 'csv')
+    if file_format == 'csv':
+        return current_app.response_class(stream_with_context(export_csv(entity)), mimetype='text/csv',
+                                          headers={'Content-Disposition': f'attachment; filename={entity}.csv'})
+    if file_format == 'npz':
+        buffer = io.BytesIO()
+        export_npz(entity, buffer)
+        return current_app.response_class(buffer.getvalue(), mimetype='application/octet-stream',
+                                          headers={'Content-Disposition': f'attachment; filename={entity}.npz'})
+    abort(400)
+
+#   flask import-data members members.csv
+@click.command('import-data')
+@click.argument('entity', type=click.Choice(list(bulk_entities)))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@with_appcontext
+def import_data_command(entity, path):
+    file_format = 'npz' if path.endswith('.npz') else 'csv'
+    with open(path, 'rb') as file:
+        try:
+            count = import_file(entity, file, file_format)
+        except BulkImportError as error:
+            raise click.ClickException(str(error))
+    click.echo(f'Imported {count} {entity}.')
+
+#   flask export-data members members.npz
+@click.command('export-data')
+@click.argument('entity', type=click.Choice(list(bulk_entities)))
+@click.argument('path', type=click.Path(dir_okay=False, writable=True))
+@with_appcontext
+def export_data_command(entity, path):
+    if path.endswith('.npz'):
+        with open(path, 'wb') as file:
+            export_npz(entity, file)
+    else:
+        with open(path, 'w', encoding='utf-8', newline='') as file:
+            file.writelines(export_csv(entity))
+    click.echo(f'Exported {entity} to {path}.')
+
+
 if __name__ == "__main__":
-    app.run()
+    create_app().run()
 
 # "POST" test data
 member_test_data = {
@@ -0,0 +1,33 @@
+import pytest
+from sqlalchemy import event
+
+import pj
+
+
+@pytest.fixture
+def app():
+    # Every test gets its own in-memory database.
+    app = pj.create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://'})
+    with app.app_context():
+        pj.db.create_all()
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+# SQL statements executed while the test runs; clear() it before the request under test.
+@pytest.fixture
+def statements(app):
+    executed = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        executed.append(statement)
+
+    with app.app_context():
+        engine = pj.db.engine
+    event.listen(engine, 'before_cursor_execute', record)
+    yield executed
+    event.remove(engine, 'before_cursor_execute', record)
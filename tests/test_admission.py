@@ -0,0 +1,120 @@
+import threading
+
+import pytest
+
+import pj
+
+
+# A file database: every thread gets its own connection, and an in-memory one would be
+# a separate, empty database per connection.
+@pytest.fixture
+def app(tmp_path):
+    app = pj.create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{tmp_path / "test.db"}',
+                         'WRITE_GROUP_COMMIT_MS': 300})
+    with app.app_context():
+        pj.db.create_all()
+        pj.db.session.add(pj.Member('luke', 'M', 88))
+        pj.db.session.add(pj.Product('bed', 1000, 50, 7, 10.0))
+        pj.db.session.commit()
+    return app
+
+
+def order(**changes):
+    data = {'member_id': 1, 'total_amount': 100, 'date': '2022-06-15', 'product_id': 1, 'quantity': 1}
+    data.update(changes)
+    return data
+
+
+# Post the orders at the same time, so they land in one group commit.
+def post_together(app, orders):
+    barrier = threading.Barrier(len(orders))
+    responses = [None] * len(orders)
+
+    def post(i):
+        client = app.test_client()
+        barrier.wait()
+        responses[i] = client.post('/order', json=orders[i])
+
+    threads = [threading.Thread(target=post, args=(i,)) for i in range(len(orders))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return responses
+
+
+def stored(app):
+    with app.app_context():
+        member = pj.Member.query.get(1)
+        return pj.Order.query.count(), member.monetary, pj.Product.query.get(1).on_hand_balance
+
+
+def test_group_commit(app):
+    responses = post_together(app, [order(total_amount=100), order(total_amount=200), order(total_amount=300)])
+    assert [response.status_code for response in responses] == [200, 200, 200]
+    assert sorted(response.get_json()['total_amount'] for response in responses) == [100, 200, 300]
+    assert stored(app) == (3, 600, 47)
+
+    stats = app.test_client().get('/admission').get_json()
+    assert stats['batches'] == 1
+    assert stats['batched_orders'] == 3
+    assert stats['largest_batch'] == 3
+    assert stats['admitted'] == 3
+    assert stats['pending'] == 0
+
+
+def test_invalid_order_only_fails_itself(app):
+    responses = post_together(app, [order(), order(member_id=99), order(quantity='many'), order()])
+    assert sorted(response.status_code for response in responses) == [200, 200, 400, 404]
+    assert stored(app) == (2, 200, 48)
+
+
+def test_failing_order_is_retried_without(app, monkeypatch):
+    create_order = pj.create_order
+
+    def failing_create_order(request_data):
+        new_order = create_order(request_data)
+        if request_data['total_amount'] == 666:
+            raise RuntimeError('boom')
+        return new_order
+
+    monkeypatch.setattr(pj, 'create_order', failing_create_order)
+    responses = post_together(app, [order(total_amount=100), order(total_amount=666), order(total_amount=200)])
+    assert sorted(response.status_code for response in responses) == [200, 200, 500]
+    assert stored(app) == (2, 300, 48)
+
+
+def test_failed_commit_fails_the_whole_batch(app, monkeypatch):
+    def failing_commit():
+        raise RuntimeError('disk full')
+
+    monkeypatch.setattr(pj.db.session, 'commit', failing_commit)
+    responses = post_together(app, [order(), order(), order()])
+    monkeypatch.undo()
+    assert [response.status_code for response in responses] == [500, 500, 500]
+    assert stored(app) == (0, 0, 50)
+
+
+def test_rate_limit(app):
+    app.config.update(WRITE_BURST=2, WRITE_RATE=0.5, WRITE_GROUP_COMMIT_MS=0)
+    client = app.test_client()
+    assert [client.post('/order', json=order()).status_code for _ in range(2)] == [200, 200]
+    response = client.post('/order', json=order())
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '2'
+
+    # Clients are told apart by the address the proxy forwarded.
+    response = client.post('/order', json=order(), headers={'X-Forwarded-For': '10.0.0.2'})
+    assert response.status_code == 200
+    assert client.get('/admission').get_json()['rate_limited'] == 1
+
+
+def test_queue_full(app):
+    app.config['WRITE_QUEUE_SIZE'] = 0
+    client = app.test_client()
+    response = client.post('/order', json=order())
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+    stats = client.get('/admission').get_json()
+    assert stats['queue_full'] == 1
+    assert stats['admitted'] == 0
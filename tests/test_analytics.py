@@ -0,0 +1,84 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import pj
+
+TODAY = datetime(2022, 6, 15)
+
+
+class FrozenDatetime(datetime):
+    @classmethod
+    def today(cls):
+        return cls(TODAY.year, TODAY.month, TODAY.day)
+
+
+# (days before TODAY, total_amount) per member; the last member never ordered.
+ORDERS = [
+    [(800, 100), (200, 300)],
+    [(500, 200), (30, 150)],
+    [(400, 500)],
+    [(100, 50), (10, 60), (5, 70)],
+    [(600, 250)],
+    [],
+]
+
+
+@pytest.fixture
+def members(app, monkeypatch):
+    monkeypatch.setattr(pj, 'datetime', FrozenDatetime)
+    with app.app_context():
+        for i, orders in enumerate(ORDERS):
+            member = pj.Member(f'member {i}', 'F', 30)
+            # Kept in step with the orders, as add_order does.
+            member.monetary = sum(amount for _, amount in orders)
+            pj.db.session.add(member)
+            pj.db.session.flush()
+            for days, amount in orders:
+                pj.db.session.add(pj.Order(amount, member.id, TODAY - timedelta(days=days), 1, 1))
+        pj.db.session.commit()
+
+
+# The batch sweep at TODAY must agree with the single-date endpoints.
+@pytest.mark.parametrize('processes', [1, 2])
+def test_batch_matches_single_date_endpoints(app, client, members, processes):
+    app.config['ANALYTICS_PROCESSES'] = processes
+    try:
+        response = client.post('/analytics/batch', json={'as_of': ['2021-01-01', TODAY.strftime('%Y-%m-%d')]})
+    finally:
+        pool = app.extensions.pop('analytics_pool', None)
+        if pool:
+            pool.shutdown()
+    assert response.status_code == 200
+    batch = response.get_json()
+    today = TODAY.strftime('%Y-%m-%d')
+
+    assert batch['repurchase_rate'][1] == client.get('/repurchase-rate').get_json()['repurchase_rate']
+
+    rfm = [member['id'] for member in client.get('/rfm').get_json()]
+    assert rfm
+    assert [member_id for as_of, member_id in zip(batch['rfm']['as_of'], batch['rfm']['member_id'])
+            if as_of == today] == sorted(rfm)
+
+    active = batch['active_rate']
+    rows = [i for i, as_of in enumerate(active['as_of']) if as_of == today]
+    for i, expected in zip(rows, client.get('/active-rate').get_json()):
+        assert active['member_id'][i] == expected['member_id']
+        assert active['purchase_time'][i] == expected['purchase_time']
+        assert active['months_ago_purchase'][i] == pytest.approx(expected['months_ago_purchase'])
+        assert active['active_rate'][i] == pytest.approx(expected['active_rate'])
+    assert len(rows) == len(ORDERS)
+
+
+@pytest.mark.parametrize('body', [
+    {'as_of': []},
+    {'as_of': ['2022-13-01']},
+    {},
+    {'as_of': ['2022-01-01'], 'metrics': 5},
+    {'as_of': ['2022-01-01'], 'metrics': 'rfm'},
+    {'as_of': ['2022-01-01'], 'metrics': ['bogus']},
+])
+def test_batch_rejects_bad_dates(app, client, body):
+    response = client.post('/analytics/batch', json=body)
+    assert response.status_code == 400
+    assert response.get_json()['errors']
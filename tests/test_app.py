@@ -0,0 +1,37 @@
+import os
+import subprocess
+import sys
+
+from sqlalchemy import inspect
+
+import pj
+
+
+# Importing pj and building the app must not connect: the database may not exist yet
+# when gunicorn preloads the app, and init-db is what creates it.
+def test_import_and_create_app_leave_the_database_alone(tmp_path):
+    path = tmp_path / 'app.db'
+    env = dict(os.environ, DATABASE_URL=f'sqlite:///{path}')
+    subprocess.run([sys.executable, '-c', 'import pj; pj.create_app()'], env=env, check=True,
+                   cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    assert not path.exists()
+
+
+def test_startup_seconds():
+    app = pj.create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://'})
+    assert 0 < app.config['STARTUP_SECONDS'] < 60
+
+
+def test_init_db_creates_tables_and_indexes(tmp_path):
+    app = pj.create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{tmp_path / "app.db"}'})
+    runner = app.test_cli_runner()
+    # Running it again, as every deploy does, must be harmless.
+    for _ in range(2):
+        result = runner.invoke(args=['init-db'])
+        assert result.exit_code == 0, result.output
+
+    with app.app_context():
+        inspector = inspect(pj.db.engine)
+        assert set(pj.db.metadata.tables) <= set(inspector.get_table_names())
+        assert 'ix_order_date' in {index['name'] for index in inspector.get_indexes('order')}
+        assert sorted(row.name for row in pj.Resource_Version.query) == sorted(pj.cached_resources)
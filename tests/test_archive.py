@@ -0,0 +1,64 @@
+from datetime import datetime
+
+import pj
+
+
+def add_orders(app, orders):
+    with app.app_context():
+        for i, member_orders in enumerate(orders):
+            member = pj.Member(f'member {i}', 'M', 40)
+            member.monetary = sum(amount for _, amount in member_orders)
+            pj.db.session.add(member)
+            pj.db.session.flush()
+            for date, amount in member_orders:
+                pj.db.session.add(pj.Order(amount, member.id, date, 1, 1))
+        pj.db.session.commit()
+
+
+def archive(app, year):
+    return app.test_cli_runner().invoke(args=['archive-orders', str(year)])
+
+
+def test_archive_moves_orders_within_the_database(app):
+    add_orders(app, [[(datetime(2015, 3, 1), 500), (datetime(2016, 1, 1), 400)]])
+    result = archive(app, 2015)
+    assert result.exit_code == 0, result.output
+    assert 'Archived 1 orders of 2015.' in result.output
+
+    with app.app_context():
+        assert [(order.order_id, order.total_amount, order.date) for order in pj.Archived_Order.query] == [
+            (1, 500, datetime(2015, 3, 1))]
+        assert [order.order_id for order in pj.Order.query] == [2]
+        archived = pj.Order_Archive.query.get(2015)
+        assert (archived.orders, archived.total_amount) == (1, 500)
+        # Season sales of the year are kept.
+        assert pj.Season_Sale.query.get((2015, 1)).sale == 500
+
+    assert 'already archived' in archive(app, 2015).output
+
+
+# Member 1 only ordered in the archived year and is still the one /rfm selects.
+def test_rfm_and_batch_include_archived_orders(app, client):
+    add_orders(app, [[(datetime(2015, 3, 1), 500), (datetime(2015, 5, 1), 400)],
+                     [(datetime.today(), 300)],
+                     [(datetime.today(), 50)]])
+    body = {'as_of': ['2016-01-01', datetime.today().strftime('%Y-%m-%d')], 'metrics': ['rfm']}
+    before = client.get('/rfm').get_json()
+    batch_before = client.post('/analytics/batch', json=body).get_json()
+
+    result = archive(app, 2015)
+    assert result.exit_code == 0, result.output
+    assert client.get('/rfm').get_json() == before
+    assert [member['id'] for member in before] == [1]
+    assert client.post('/analytics/batch', json=body).get_json() == batch_before
+
+    # The /order endpoints only list the orders left in the table.
+    assert len(client.get('/order').get_json()) == 2
+    assert client.get('/order/mid=2').status_code == 200
+    assert client.get('/order/mid=1').status_code == 404
+
+
+def test_recent_years_cannot_be_archived(app):
+    result = archive(app, datetime.today().year - 1)
+    assert result.exit_code != 0
+    assert 'more than two years ago' in result.output
@@ -0,0 +1,117 @@
+import gzip
+from datetime import datetime
+
+import pytest
+
+import pj
+
+
+@pytest.fixture
+def data(app):
+    with app.app_context():
+        pj.db.session.add(pj.Member('luke', 'M', 88))
+        pj.db.session.add(pj.Product('bed', 1000, 50, 7, 10.0))
+        material = pj.Material('spring')
+        material.on_hand_balance = 100
+        material.leading_time = 7
+        material.reorder_point = 20.0
+        pj.db.session.add(material)
+        pj.db.session.add(pj.Season_Sale(2015, 1, 100))
+        pj.db.session.add(pj.Order(100, 1, datetime(2015, 2, 1), 1, 1))
+        pj.db.session.commit()
+
+
+def test_matching_etag_skips_the_view(app, client, data, statements):
+    response = client.get('/products')
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+
+    statements.clear()
+    response = client.get('/products', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+    assert response.get_data() == b''
+    # Only the version lookup, none of the view's queries.
+    assert len(statements) == 1
+
+
+def test_weak_etag_matches(app, client, data):
+    etag = client.get('/products').headers['ETag']
+    response = client.get('/products', headers={'If-None-Match': f'W/{etag}'})
+    assert response.status_code == 304
+
+
+def test_last_modified(app, client, data):
+    with app.app_context():
+        pj.bump_version('product')
+        pj.db.session.commit()
+    response = client.get('/products')
+    last_modified = response.headers['Last-Modified']
+    response = client.get('/products', headers={'If-Modified-Since': last_modified})
+    assert response.status_code == 304
+
+
+def test_compressed_etag_round_trip(app, client, data):
+    app.config['COMPRESS_MIN_SIZE'] = 0
+    headers = {'Accept-Encoding': 'gzip'}
+    response = client.get('/products', headers=headers)
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(response.get_data()) == client.get('/products').get_data()
+    etag = response.headers['ETag']
+    assert etag.endswith('-gzip"')
+
+    response = client.get('/products', headers=dict(headers, **{'If-None-Match': etag}))
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+
+
+def add_order(app, client):
+    return client.post('/order', json={'member_id': 1, 'total_amount': 50, 'date': '2022-01-01',
+                                       'product_id': 1, 'quantity': 1})
+
+
+def delete_order(app, client):
+    return client.delete('/order/1')
+
+
+def update_inventory(app, client):
+    return client.put('/inventory', json={
+        'products': [{'product_id': 1, 'leading_time': 3, 'reorder_point': 5.0}],
+        'materials': [{'material_id': 1, 'leading_time': 3, 'reorder_point': 5.0}]})
+
+
+def add_season_sale(app, client):
+    return client.post('/ssale', json={'year': 2015, 'season': 2, 'sale': 200})
+
+
+def import_products(app, client):
+    return client.post('/import/products', data='product_name,price,on_hand_balance,leading_time,reorder_point\r\n'
+                                                 'sofa,500,5,3,1.0\r\n', content_type='text/csv')
+
+
+def archive_orders(app, client):
+    return app.test_cli_runner().invoke(args=['archive-orders', '2015'])
+
+
+# Every write path must change the ETag of the endpoints reading what it changed.
+@pytest.mark.parametrize('write, url', [
+    (add_order, '/products'),
+    (add_order, '/ssale'),
+    (delete_order, '/products'),
+    (delete_order, '/ssale'),
+    (update_inventory, '/products'),
+    (update_inventory, '/inventory'),
+    (add_season_sale, '/ssale'),
+    (import_products, '/products'),
+    (archive_orders, '/ssale'),
+])
+def test_writes_change_the_etag(app, client, data, write, url):
+    etag = client.get(url).headers['ETag']
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+
+    result = write(app, client)
+    assert getattr(result, 'status_code', None) == 200 or getattr(result, 'exit_code', None) == 0
+
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
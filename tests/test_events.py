@@ -0,0 +1,54 @@
+from datetime import datetime
+
+import pj
+
+
+def add_events(*ids):
+    for event_id in ids:
+        row = pj.Stock_Event('stock', 'product', 1, 'bed', 5, 2.0, datetime(2022, 1, 1))
+        row.id = event_id
+        pj.db.session.add(row)
+    pj.db.session.commit()
+
+
+def published(broker):
+    return [event_id for event_id, _ in broker.events]
+
+
+def test_poll_holds_back_events_after_a_gap(app):
+    with app.app_context():
+        broker = pj.EventBroker(app)
+        add_events(1, 3)
+        broker.poll_once()
+        assert published(broker) == [1]
+
+        # The missing id commits late and releases everything behind it.
+        add_events(2)
+        broker.poll_once()
+        assert published(broker) == [1, 2, 3]
+
+
+def test_poll_skips_a_gap_after_the_timeout(app):
+    app.config['EVENTS_GAP_TIMEOUT'] = 0
+    with app.app_context():
+        broker = pj.EventBroker(app)
+        add_events(1, 3)
+        broker.poll_once()
+        assert published(broker) == [1, 3]
+
+
+def test_prune_keeps_the_replay_window(app):
+    with app.app_context():
+        add_events(*range(1, 11))
+        pj.prune_stock_events(4)
+        assert [row.id for row in pj.Stock_Event.query.order_by(pj.Stock_Event.id)] == [7, 8, 9, 10]
+
+
+def test_prune_events_command(app):
+    app.config['EVENTS_BUFFER_SIZE'] = 2
+    with app.app_context():
+        add_events(1, 2, 3)
+    result = app.test_cli_runner().invoke(args=['prune-events'])
+    assert result.exit_code == 0
+    with app.app_context():
+        assert pj.Stock_Event.query.count() == 2
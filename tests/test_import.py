@@ -0,0 +1,83 @@
+import io
+
+import numpy as np
+
+import pj
+
+
+def post_csv(client, entity, text):
+    data = text.encode() if isinstance(text, str) else text
+    return client.post(f'/import/{entity}', data=data, content_type='text/csv')
+
+
+def test_import_and_export_csv(app, client):
+    response = post_csv(client, 'members', 'id,member_name,sex,age\r\n1,luke,M,88\r\n2,leia,F,87\r\n')
+    assert response.status_code == 200
+    assert response.get_json() == {'entity': 'members', 'imported': 2}
+
+    response = client.get('/export/members')
+    assert response.get_data(as_text=True) == 'id,member_name,sex,age,monetary\r\n1,luke,M,88,0\r\n2,leia,F,87,0\r\n'
+
+
+def test_import_rejects_invalid_utf8(app, client):
+    response = post_csv(client, 'members', b'member_name,sex,age\r\n\xff\xfe,M,88\r\n')
+    assert response.status_code == 400
+    assert response.get_json() == {'errors': ['the file is not valid UTF-8 text']}
+
+
+def test_import_rejects_unknown_columns(app, client):
+    response = post_csv(client, 'members', 'member_name,sex,age,bogus\r\nluke,M,88,1\r\n')
+    assert response.status_code == 400
+    assert response.get_json() == {'errors': ["unknown column 'bogus'"]}
+    with app.app_context():
+        assert pj.Member.query.count() == 0
+
+
+def test_import_rejects_extra_values(app, client):
+    response = post_csv(client, 'members', 'member_name,sex,age\r\nluke,M,88,1\r\n')
+    assert response.status_code == 400
+    assert response.get_json() == {'errors': ['row 1: more values than columns']}
+
+
+def test_import_npz(app, client):
+    buffer = io.BytesIO()
+    np.savez(buffer, member_name=np.array(['luke']), sex=np.array(['M']), age=np.array([88]))
+    response = client.post('/import/members?format=npz', data=buffer.getvalue())
+    assert response.status_code == 200
+
+    buffer = io.BytesIO()
+    np.savez(buffer, member_name=np.array(['luke']), bogus=np.array([1]))
+    response = client.post('/import/members?format=npz', data=buffer.getvalue())
+    assert response.get_json() == {'errors': ["unknown column 'bogus'"]}
+
+    response = client.post('/import/members?format=npz', data=b'not an npz file')
+    assert response.status_code == 400
+    assert response.get_json()['errors'][0].startswith('not a valid .npz file')
+
+
+def test_import_multipart_upload(app, client):
+    data = {'file': (io.BytesIO('member_name,sex,age\r\n"luke\r\nskywalker",M,88\r\n'.encode()), 'members.csv')}
+    response = client.post('/import/members', data=data, content_type='multipart/form-data')
+    assert response.status_code == 200
+    assert response.get_json() == {'entity': 'members', 'imported': 1}
+    with app.app_context():
+        assert pj.Member.query.get(1).member_name == 'luke\r\nskywalker'
+
+
+# Pairs the table already has, or repeated in the file, are not counted as imported.
+def test_import_counts_rows_written(app, client):
+    post_csv(client, 'materials', 'material_id,material_name,on_hand_balance,leading_time,reorder_point\r\n'
+                                  '1,spring,10,3,1.0\r\n2,foam,10,3,1.0\r\n3,wood,10,3,1.0\r\n')
+    header = 'material_id,raw_material_id\r\n'
+    response = post_csv(client, 'material_material', header + '1,2\r\n1,2\r\n')
+    assert response.get_json()['imported'] == 1
+    response = post_csv(client, 'material_material', header + '1,2\r\n1,3\r\n')
+    assert response.get_json()['imported'] == 1
+
+    post_csv(client, 'products', 'product_id,product_name,price,on_hand_balance,leading_time,reorder_point\r\n'
+                                 '1,bed,1000,5,3,1.0\r\n')
+    header = 'product_id,material_id\r\n'
+    response = post_csv(client, 'product_material', header + '1,1\r\n1,1\r\n1,2\r\n')
+    assert response.get_json()['imported'] == 2
+    response = post_csv(client, 'product_material', header + '1,1\r\n')
+    assert response.get_json()['imported'] == 0
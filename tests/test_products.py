@@ -0,0 +1,51 @@
+import pytest
+
+import pj
+
+
+def add_bom(app, n_products):
+    with app.app_context():
+        materials = []
+        for i in range(4):
+            material = pj.Material(f'material {i}')
+            material.on_hand_balance = 100
+            material.leading_time = 7
+            material.reorder_point = 150.0
+            materials.append(material)
+        pj.db.session.add_all(materials)
+        for i in range(n_products):
+            product = pj.Product(f'product {i}', 1000, 50, 7, 100.0)
+            product.product_material_relation = materials[i % 2:i % 2 + 3]
+            pj.db.session.add(product)
+        pj.db.session.flush()
+        pj.db.session.add(pj.Material_Material(materials[0].material_id, materials[3].material_id))
+        pj.db.session.commit()
+
+
+# The statement counts must not depend on how many products there are: one more per
+# product would be an N+1 on product_material. Each count includes the ETag lookup.
+@pytest.mark.parametrize('n_products', [4, 12])
+@pytest.mark.parametrize('url, expected', [
+    ('/products', 3),
+    ('/products?include=materials', 4),
+    ('/products/page/1', 4),
+    ('/products/page/1?include=materials', 5),
+    ('/inventory', 5),
+    ('/inventory?include=materials', 6),
+    ('/mrp', 5),
+])
+def test_statement_counts(app, client, statements, n_products, url, expected):
+    add_bom(app, n_products)
+    statements.clear()
+    response = client.get(url)
+    assert response.status_code == 200
+    assert len(statements) == expected
+
+
+def test_materials_only_when_included(app, client):
+    add_bom(app, 4)
+    products = client.get('/products').get_json()
+    assert all('materials' not in product for product in products)
+
+    products = client.get('/products?include=materials').get_json()
+    assert [sorted(product['materials']) for product in products] == [[1, 2, 3], [2, 3, 4], [1, 2, 3], [2, 3, 4]]